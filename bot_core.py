@@ -0,0 +1,490 @@
+"""
+飞书机器人与通义千问的核心逻辑，与 Web 框架无关。
+连接池、token 缓存、回复缓存和事件去重都是模块级单例，由入口文件（app.py）负责启动和关闭。
+"""
+import os
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import httpx
+import orjson
+import redis.asyncio as aioredis
+
+# ---------- 日志 ----------
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# ---------- 环境变量（在 ECS 上设置） ----------
+FEISHU_APP_ID = os.getenv("FEISHU_APP_ID", "")
+FEISHU_APP_SECRET = os.getenv("FEISHU_APP_SECRET", "")
+
+QWEN_API_KEY = os.getenv("QWEN_API_KEY", "")
+QWEN_MODEL = os.getenv("QWEN_MODEL", "qwen-plus")
+
+REDIS_URL = os.getenv("REDIS_URL", "")  # 多进程 / 多实例部署时用于共享事件去重
+
+# ---------- 固定不变的请求参数，启动时构造一次 ----------
+QWEN_URL = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+QWEN_HEADERS = {
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {QWEN_API_KEY}",
+    "X-DashScope-SSE": "enable",
+}
+SYSTEM_MSG = {
+    "role": "system",
+    "content": "你是一个企业内部智能助手，回答要简洁、专业、直接，默认用简体中文。",
+}
+QWEN_BASE_PAYLOAD = {
+    "model": QWEN_MODEL,
+    "parameters": {
+        "result_format": "message",
+        "incremental_output": True,
+    },
+}
+# 请求体里除用户消息外的部分预先编码成 bytes，每次只编码用户消息再拼接；
+# 系统提示词每次请求逐字节一致，也便于命中服务端的 prompt cache
+QWEN_BODY_PREFIX, QWEN_BODY_SUFFIX = orjson.dumps(
+    QWEN_BASE_PAYLOAD | {"input": {"messages": [SYSTEM_MSG, None]}}
+).rsplit(b"null", 1)
+
+FEISHU_TOKEN_URL = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal"
+FEISHU_TOKEN_BODY = orjson.dumps({"app_id": FEISHU_APP_ID, "app_secret": FEISHU_APP_SECRET})
+FEISHU_REPLY_URL = "https://open.feishu.cn/open-apis/im/v1/messages/{}/reply"
+FEISHU_JSON_HEADERS = {"Content-Type": "application/json; charset=utf-8"}
+
+# 建连单独设较短超时；千问流式调用另有整体超时，避免一次生成无限拖长
+QWEN_TIMEOUT = httpx.Timeout(30, connect=5)
+QWEN_TOTAL_TIMEOUT = 30  # 秒
+FEISHU_TIMEOUT = httpx.Timeout(10, connect=5)
+
+# ---------- 复用 HTTP 连接（飞书 / 通义千问共用一个异步连接池） ----------
+client: Optional[httpx.AsyncClient] = None
+
+
+KEEPALIVE_EXPIRY = 120  # 秒，空闲连接保留更久，减少重新握手 TLS
+
+
+def _pooled_transport(max_connections: int) -> httpx.AsyncHTTPTransport:
+    # 传入自定义 transport 时，连接池参数要配置在 transport 上；retries 只重试建连失败
+    return httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections // 2,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+        retries=2,
+    )
+
+
+async def startup() -> None:
+    global client
+    # 只有飞书和千问两个上游，各用一个独立连接池：千问的长时间流式连接不会占满飞书回复的连接
+    client = httpx.AsyncClient(
+        timeout=QWEN_TIMEOUT,
+        mounts={
+            "https://open.feishu.cn": _pooled_transport(50),
+            "https://dashscope.aliyuncs.com": _pooled_transport(100),
+        },
+        transport=_pooled_transport(20),
+    )
+
+
+async def shutdown() -> None:
+    if client is not None:
+        await client.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
+# ---------- 通义千问回复缓存（相同问题短时间内直接复用） ----------
+QWEN_CACHE_MAXSIZE = 1024
+QWEN_CACHE_TTL = 300  # 秒
+QWEN_CACHE: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+
+def _qwen_cache_key(user_msg: str) -> str:
+    return hashlib.blake2b(f"{QWEN_MODEL}|{user_msg}".encode(), digest_size=16).hexdigest()
+
+
+def _qwen_cache_get(key: str) -> Optional[str]:
+    hit = QWEN_CACHE.get(key)
+    if hit is None:
+        return None
+    cached_at, content = hit
+    if time.time() - cached_at > QWEN_CACHE_TTL:
+        del QWEN_CACHE[key]
+        return None
+    QWEN_CACHE.move_to_end(key)
+    return content
+
+
+def _qwen_cache_put(key: str, content: str) -> None:
+    QWEN_CACHE[key] = (time.time(), content)
+    QWEN_CACHE.move_to_end(key)
+    while len(QWEN_CACHE) > QWEN_CACHE_MAXSIZE:
+        QWEN_CACHE.popitem(last=False)
+
+
+# ---------- 进行中的千问请求（并发的相同问题合并成一次调用） ----------
+INFLIGHT: "Dict[str, asyncio.Future[str]]" = {}
+
+
+# ---------- 通义千问 ----------
+async def call_qwen(user_msg: str) -> str:
+    if not QWEN_API_KEY:
+        return "后端未配置 QWEN_API_KEY，请联系管理员设置环境变量。"
+
+    cache_key = _qwen_cache_key(user_msg)
+    cached = _qwen_cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    # 相同问题已有请求在路上，直接等它的结果，不再重复调用千问
+    pending = INFLIGHT.get(cache_key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+
+    future: "asyncio.Future[str]" = asyncio.get_running_loop().create_future()
+    INFLIGHT[cache_key] = future
+    try:
+        try:
+            reply = await asyncio.wait_for(_stream_qwen(user_msg), QWEN_TOTAL_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"调用通义千问超时（{QWEN_TOTAL_TIMEOUT}s）")
+            reply = "通义千问响应超时，请稍后重试。"
+        except Exception as e:
+            logger.exception("调用通义千问失败")
+            reply = f"调用通义千问出错：{e}"
+        else:
+            if reply:
+                _qwen_cache_put(cache_key, reply)
+            else:
+                reply = "通义千问没有返回内容，请稍后重试。"
+        future.set_result(reply)
+    finally:
+        # 被取消时也要唤醒等待者，并清理登记
+        if not future.done():
+            future.cancel()
+        INFLIGHT.pop(cache_key, None)
+
+    return reply
+
+
+async def _stream_qwen(user_msg: str) -> str:
+    """
+    流式调用千问，返回拼接好的完整回复；出错时直接抛异常
+    """
+    payload = QWEN_BODY_PREFIX + orjson.dumps({"role": "user", "content": user_msg}) + QWEN_BODY_SUFFIX
+
+    # 流式读取（SSE），每个 data 帧只带增量内容，边收边拼接
+    parts = []
+    async with client.stream(
+        "POST", QWEN_URL, headers=QWEN_HEADERS, content=payload, timeout=QWEN_TIMEOUT
+    ) as resp:
+        resp.raise_for_status()
+        async for line in resp.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = orjson.loads(line[5:])
+
+            if data.get("code"):
+                raise RuntimeError(f"{data.get('code')}: {data.get('message')}")
+
+            output = data.get("output", {})
+            choices = output.get("choices")
+            if choices:
+                message = choices[0].get("message", {})
+                content = message.get("content")
+                if content:
+                    parts.append(content)
+                continue
+
+            text = output.get("text")
+            if text:
+                parts.append(text)
+
+    return "".join(parts)
+
+
+# ---------- 获取 tenant_access_token，用来回消息 ----------
+TOKEN_REFRESH_RATIO = float(os.getenv("FEISHU_TOKEN_REFRESH_RATIO", "0.8"))  # 有效期用掉多少比例后刷新
+
+_tenant_access_token: Optional[str] = None
+_token_issued_at: float = 0  # 时间戳
+_token_expire: float = 0  # 时间戳
+_token_lock = asyncio.Lock()
+
+# 飞书判定 tenant_access_token 无效 / 过期时返回的错误码
+FEISHU_TOKEN_INVALID_CODES = frozenset({99991661, 99991663})
+
+
+def _token_is_fresh() -> bool:
+    refresh_at = _token_issued_at + TOKEN_REFRESH_RATIO * (_token_expire - _token_issued_at)
+    return bool(_tenant_access_token) and time.time() < refresh_at
+
+
+async def get_tenant_access_token(force_refresh: bool = False) -> str:
+    """
+    根据 app_id / app_secret 获取 tenant_access_token
+    并发请求共用一把锁，同一时间只有一个协程去刷新；force_refresh 用于 token 被飞书判定失效时
+    """
+    global _tenant_access_token, _token_issued_at, _token_expire
+
+    stale_token = _tenant_access_token if force_refresh else None
+    if not force_refresh and _token_is_fresh():
+        return _tenant_access_token
+
+    async with _token_lock:
+        # 等锁期间可能已经有别的协程刷新过了
+        if _token_is_fresh() and _tenant_access_token != stale_token:
+            return _tenant_access_token
+
+        resp = await client.post(
+            FEISHU_TOKEN_URL, headers=FEISHU_JSON_HEADERS, content=FEISHU_TOKEN_BODY, timeout=FEISHU_TIMEOUT
+        )
+        data = orjson.loads(resp.content)
+        if data.get("code") != 0:
+            raise RuntimeError(f"获取 tenant_access_token 失败: {data}")
+
+        now = time.time()
+        _tenant_access_token = data["tenant_access_token"]
+        _token_issued_at = now
+        _token_expire = now + data.get("expire", 3600)
+        return _tenant_access_token
+
+
+async def feishu_reply_message(message_id: str, text: str) -> None:
+    """
+    调用飞书接口，回复一条消息。
+    这里用的是「reply」接口，你也可以改成按 chat_id 发新消息。
+    """
+    if not FEISHU_APP_ID or not FEISHU_APP_SECRET:
+        logger.error("FEISHU_APP_ID / FEISHU_APP_SECRET 未配置，无法回复消息")
+        return
+
+    url = FEISHU_REPLY_URL.format(message_id)
+    body = orjson.dumps({
+        "msg_type": "text",
+        "content": orjson.dumps({"text": text}).decode(),
+    })
+
+    try:
+        for attempt in range(2):
+            try:
+                token = await get_tenant_access_token(force_refresh=attempt > 0)
+            except Exception:
+                logger.exception("获取 tenant_access_token 失败，无法回复消息")
+                return
+
+            headers = {**FEISHU_JSON_HEADERS, "Authorization": f"Bearer {token}"}
+            resp = await client.post(url, headers=headers, content=body, timeout=FEISHU_TIMEOUT)
+            # token 提前失效（如被重置）时强制刷新一次再重试；飞书一般以 HTTP 400 + 业务错误码返回
+            if resp.status_code == 401:
+                data = {"code": resp.status_code, "msg": resp.text}
+            else:
+                data = orjson.loads(resp.content)
+                if data.get("code") not in FEISHU_TOKEN_INVALID_CODES:
+                    break
+            logger.warning("tenant_access_token 已失效，刷新后重试")
+
+        if data.get("code") != 0:
+            logger.error(f"回复消息失败: {data}")
+        else:
+            logger.info("已回复飞书消息")
+    except Exception:
+        logger.exception("调用飞书回复接口失败")
+
+
+# ---------- 事件去重（飞书可能重复推送同一事件） ----------
+PROCESSED_TTL = 600  # 秒
+MAX_EVENTS = 10_000
+PROCESSED_EVENTS: "OrderedDict[str, float]" = OrderedDict()
+
+# 去重在给飞书应答之前执行，Redis 慢或不可达时要尽快失败并退回本地去重，不能拖过飞书的超时
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "0.3"))  # 秒
+redis_client: Optional[aioredis.Redis] = (
+    aioredis.Redis.from_url(
+        REDIS_URL, socket_connect_timeout=REDIS_TIMEOUT, socket_timeout=REDIS_TIMEOUT
+    )
+    if REDIS_URL
+    else None
+)
+
+
+async def is_duplicate_event(event_id: str) -> bool:
+    """
+    记录 event_id，已处理过则返回 True。
+    配置了 REDIS_URL 时用 SET NX EX 原子占位，多个 worker / 实例之间共享去重结果；
+    Redis 不可用时退回本进程内存去重。
+    """
+    if redis_client is not None:
+        try:
+            claimed = await redis_client.set(f"feishu:evt:{event_id}", "1", nx=True, ex=PROCESSED_TTL)
+            return not claimed
+        except Exception:
+            logger.exception("Redis 去重失败，改用本地内存去重")
+
+    return _is_duplicate_event_local(event_id)
+
+
+def _is_duplicate_event_local(event_id: str) -> bool:
+    """
+    进程内去重。
+    按插入顺序保存，只从队头淘汰过期或超出上限的记录，均摊 O(1)。
+    """
+    now = time.time()
+    if event_id in PROCESSED_EVENTS:
+        # 刷新时间戳并移到队尾，保证队头始终是最早的记录
+        PROCESSED_EVENTS[event_id] = now
+        PROCESSED_EVENTS.move_to_end(event_id)
+        return True
+
+    PROCESSED_EVENTS[event_id] = now
+    while len(PROCESSED_EVENTS) > MAX_EVENTS or next(iter(PROCESSED_EVENTS.values())) < now - PROCESSED_TTL:
+        PROCESSED_EVENTS.popitem(last=False)
+    return False
+
+
+# ---------- 飞书重推拦截（请求头里的时间戳 / nonce） ----------
+MAX_REQUEST_AGE = 60  # 秒，超过这个时间的推送基本是重试
+# nonce 保留时长：Redis 和本地内存用同一规则。
+# 取事件去重的窗口，没带时间戳的重推在这段时间内都能拦住
+NONCE_TTL = PROCESSED_TTL
+MAX_NONCES = MAX_EVENTS  # 仅为本地内存设上限，正常流量下不会先于 NONCE_TTL 触发
+_seen_nonces: "deque[Tuple[float, str]]" = deque()  # (记录时间, nonce)，按时间先后排列
+_seen_nonce_set: "set[str]" = set()
+
+
+def is_stale_request(timestamp: Optional[str]) -> bool:
+    """
+    根据 X-Lark-Request-Timestamp 判断是否为过期的推送；没带或格式不对时不做判断。
+    """
+    if not timestamp:
+        return False
+    try:
+        return time.time() - int(timestamp) > MAX_REQUEST_AGE
+    except ValueError:
+        return False
+
+
+async def is_replayed_nonce(nonce: Optional[str]) -> bool:
+    """
+    记录 X-Lark-Request-Nonce，NONCE_TTL 秒内出现过则返回 True；没带 nonce 时不做判断。
+    配置了 REDIS_URL 时和事件去重一样用 SET NX EX，多个 worker / 实例之间共享；
+    否则（或 Redis 不可用时）退回本进程内存，多 worker 部署下只能拦住落到同一 worker 的重推。
+    两种方式都按 NONCE_TTL 保留，本地内存另有 MAX_NONCES 条的上限。
+    """
+    if not nonce:
+        return False
+
+    if redis_client is not None:
+        try:
+            claimed = await redis_client.set(f"feishu:nonce:{nonce}", "1", nx=True, ex=NONCE_TTL)
+            return not claimed
+        except Exception:
+            logger.exception("Redis 记录 nonce 失败，改用本地内存记录")
+
+    return _is_replayed_nonce_local(nonce)
+
+
+def _is_replayed_nonce_local(nonce: str) -> bool:
+    now = time.time()
+    # 先从队头淘汰过期或超出上限的记录
+    while _seen_nonces and (len(_seen_nonces) >= MAX_NONCES or _seen_nonces[0][0] < now - NONCE_TTL):
+        _seen_nonce_set.discard(_seen_nonces.popleft()[1])
+
+    if nonce in _seen_nonce_set:
+        return True
+    _seen_nonces.append((now, nonce))
+    _seen_nonce_set.add(nonce)
+    return False
+
+
+async def process_message(message_id: str, user_text: str) -> None:
+    """
+    后台任务：调用通义千问并回复飞书消息。
+    飞书要求回调尽快返回，耗时的模型调用放在响应之后执行，避免触发飞书重推。
+    """
+    reply_text = await call_qwen(user_text)
+    await feishu_reply_message(message_id, reply_text)
+
+
+# ---------- 飞书回调处理（与 Web 框架无关，入口文件只负责把结果转成 HTTP 响应） ----------
+ACK_OK = "ok"
+ACK_IGNORED = "ignored"
+ACK_DUPLICATE = "duplicate"
+
+
+class EventResult(NamedTuple):
+    ack: str  # ACK_OK / ACK_IGNORED / ACK_DUPLICATE
+    challenge: Optional[str] = None  # URL 校验时需要原样返回给飞书
+    task: Optional[Tuple[str, str]] = None  # (message_id, user_text)，交给 process_message 在应答之后执行
+
+
+async def handle_event(raw_body: bytes, timestamp: Optional[str], nonce: Optional[str]) -> EventResult:
+    """
+    处理一次飞书回调：拦截重推、URL 校验、过滤消息和事件去重。
+    传入原始 bytes，过期的推送在解析 body 之前就直接应答。
+    """
+    # 过期的推送是飞书重试，不解析 body
+    if is_stale_request(timestamp):
+        logger.info(f"飞书过期推送，已忽略: timestamp={timestamp}")
+        return EventResult(ACK_DUPLICATE)
+
+    # 直接用 orjson 解析原始 bytes，省去标准库解析
+    body = orjson.loads(raw_body)
+
+    # body 解析成功后再记录 nonce，解析失败的推送重试时不会被误判为重复
+    if await is_replayed_nonce(nonce):
+        logger.info(f"飞书重复推送，已忽略: nonce={nonce}")
+        return EventResult(ACK_DUPLICATE)
+
+    logger.info(f"收到飞书请求: {body}")
+
+    # 直接按 dict 读取字段，不再逐次构造 pydantic 模型
+    # 1) URL 校验
+    challenge = body.get("challenge")
+    if body.get("type") == "url_verification" and challenge:
+        return EventResult(ACK_OK, challenge=challenge)
+
+    # 2) 事件回调，其他事件先忽略
+    event = body.get("event") or {}
+    if event.get("type") != "im.message.receive_v1":
+        return EventResult(ACK_IGNORED)
+
+    message = event.get("message", {})
+    # 非文本消息（图片、文件、表情等）直接忽略，不解析 content
+    if message.get("message_type") != "text":
+        return EventResult(ACK_IGNORED)
+
+    content_raw = message.get("content", "{}")
+    message_id = message.get("message_id", "")
+
+    try:
+        user_text = orjson.loads(content_raw).get("text")
+    except Exception:
+        user_text = content_raw
+    # content 或其中的 text 可能是 null、数字等，只接受字符串
+    if not isinstance(user_text, str):
+        user_text = ""
+
+    # 空白或单个字符之类的无意义消息不调用千问
+    user_text = user_text.strip()
+    if len(user_text) < 2:
+        return EventResult(ACK_IGNORED)
+
+    event_id = (body.get("header") or {}).get("event_id") or message_id
+    if event_id and await is_duplicate_event(event_id):
+        logger.info(f"重复事件，已忽略: {event_id}")
+        return EventResult(ACK_DUPLICATE)
+
+    # 先给飞书返回 200，再在后台调用千问并主动回复
+    if not message_id:
+        logger.warning("没有拿到 message_id，无法直接回复消息")
+        return EventResult(ACK_OK)
+    return EventResult(ACK_OK, task=(message_id, user_text))
@@ -0,0 +1,9 @@
+# 生产环境启动：gunicorn -c gunicorn.conf.py app:app
+# uvicorn[standard] 自带 uvloop / httptools，UvicornWorker 会自动选用
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+keepalive = 30